@@ -7,15 +7,14 @@ from flask import Flask
 from flask import render_template, Blueprint, request, make_response
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func
 from flask_bootstrap import Bootstrap
 
-from bokeh.embed import json_item
-from bokeh.resources import CDN
-
 from werkzeug.utils import secure_filename
 from config import DATABASE_URI
-from models import FrameModel, AcquisitionModel, ClusterModel
-from visualization import generate_frame_plot, generate_cluster_plot, generate_counts_plot
+from models import FrameModel, AcquisitionModel, ClusterModel, EventModel
+from spatial import query_clusters
+from hitmap import integrated_image
 
 app = Flask(__name__)
 
@@ -38,29 +37,97 @@ def acquisition_page():
 @app.route('/acquisitions/<int:acquisition_id>')
 def acquisition_view(acquisition_id):
     acquisition = db.session.query(AcquisitionModel).filter_by(id=acquisition_id).first()
-
-    start = acquisition.frames[0]
-    end = acquisition.frames[-1]
+    start, end, count = frame_range(acquisition_id)
+    # Bokeh is only imported by the plotting views so that workers start quickly.
+    from bokeh.resources import CDN
 
     return render_template('acquisition.html',
-                           acq_start=start.id,
-                           acq_end=end.id,
-                           acq_count=len(acquisition.frames),
+                           acq_start=start,
+                           acq_end=end,
+                           acq_count=count,
                            acquisition=acquisition,
                            resources=CDN.render())
 
 
+@app.route('/acquisitions/<int:acquisition_id>/latest')
+def acquisition_latest(acquisition_id):
+    start, end, count = frame_range(acquisition_id)
+
+    return json.dumps({'acq_start': start, 'acq_end': end, 'acq_count': count})
+
+
+def frame_range(acquisition_id):
+    # Acquisitions that are still being recorded may not have any frames yet.
+    start, end, count = db.session.query(func.min(FrameModel.id),
+                                         func.max(FrameModel.id),
+                                         func.count(FrameModel.id)).filter_by(acquisition_id=acquisition_id).one()
+
+    return start or 0, end or 0, count
+
+
 @app.route('/acquisitions/<int:acquisition_id>/timeseries')
 def aquisition_timeseries(acquisition_id):
+    from bokeh.embed import json_item
+    from visualization import generate_counts_plot
+
     counts = list(db.session.query(FrameModel.counts).filter_by(acquisition_id=acquisition_id).all())
+    if not counts:
+        return make_response(('Acquisition has no frames yet', 404))
 
     plot = generate_counts_plot(counts)
     return json.dumps(json_item(plot, "acquisition_timeseries"))
 
 
+@app.route('/acquisitions/<int:acquisition_id>/hitmap')
+def acquisition_hitmap(acquisition_id):
+    from bokeh.embed import json_item
+    from visualization import generate_hitmap_plot
+
+    start = request.args.get('start', 0, type=int)
+    stop = request.args.get('stop', type=int)
+    kind = request.args.get('kind', 'hits')
+
+    if stop is None:
+        stop = frame_range(acquisition_id)[2]
+
+    try:
+        img = integrated_image(db.session, acquisition_id, start, stop, kind)
+    except ValueError as e:
+        return make_response((str(e), 400))
+
+    plot = generate_hitmap_plot(img, start, stop, kind)
+    return json.dumps(json_item(plot, "hitmap"))
+
+
+@app.route('/acquisitions/<int:acquisition_id>/events')
+def acquisition_events(acquisition_id):
+    events = db.session.query(EventModel).filter_by(acquisition_id=acquisition_id).order_by(EventModel.first_frame_id)
+
+    # Cluster ids of all events in one query instead of loading each event's clusters.
+    cluster_ids = {}
+    members = db.session.query(ClusterModel.event_id, ClusterModel.id) \
+        .join(EventModel) \
+        .filter(EventModel.acquisition_id == acquisition_id) \
+        .order_by(ClusterModel.id)
+    for event_id, cluster_id in members:
+        cluster_ids.setdefault(event_id, []).append(cluster_id)
+
+    return json.dumps([{'id': event.id,
+                        'first_frame_id': event.first_frame_id,
+                        'last_frame_id': event.last_frame_id,
+                        'cluster_count': event.cluster_count,
+                        'cluster_ids': cluster_ids.get(event.id, [])} for event in events])
+
+
 @app.route('/frame/<int:frame_id>')
 def frame(frame_id):
+    from bokeh.embed import json_item
+    from visualization import generate_frame_plot
+
     frame_obj = db.session.query(FrameModel).filter_by(id=frame_id).first()
+    if frame_obj is None:
+        return make_response(('No such frame', 404))
+
     img = generate_frame_plot(frame_obj)
 
     return json.dumps(json_item(img, "frame"))
@@ -68,6 +135,9 @@ def frame(frame_id):
 
 @app.route('/cluster/<int:cluster_id>/plot')
 def cluster_plot(cluster_id):
+    from bokeh.embed import json_item
+    from visualization import generate_cluster_plot
+
     cluster = db.session.query(ClusterModel).filter_by(id=cluster_id).first()
     img = generate_cluster_plot(cluster)
 
@@ -92,21 +162,40 @@ def cluster(cluster_id):
                           'orientation',
                           'perimeter',
                           'solidity',
+                          'event_id',
+                          'track_class',
                           'track_length']
     cluster = db.session.query(ClusterModel).filter_by(id=cluster_id).first()
-    data_dict = cluster.to_dict()
-    display_dict = {key: data_dict[key] for key in data_dict if key in display_properties}
-    return json.dumps(display_dict)
+    # to_dict probes every serializable property, which would derive the cluster images.
+    display_dict = {key: getattr(cluster, key) for key in display_properties}
+    return json.dumps(display_dict, default=str)
 
 
 @app.route('/cluster/search')
 def search():
-    pass
+    acquisition_id = request.args.get('acquisition_id', type=int)
+    t0 = request.args.get('t0', type=float)
+    t1 = request.args.get('t1', type=float)
+    overlapping = request.args.get('overlapping', 'false').lower() == 'true'
+    track_class = request.args.get('track_class')
+
+    region = [request.args.get(key, type=int) for key in ('min_row', 'min_col', 'max_row', 'max_col')]
+    if all(bound is None for bound in region):
+        region = None
+    elif any(bound is None for bound in region):
+        return make_response(('min_row, min_col, max_row and max_col must be given together', 400))
+
+    query = query_clusters(db.session, acquisition_id=acquisition_id, region=region,
+                           t0=t0, t1=t1, overlapping=overlapping, track_class=track_class)
+    cluster_ids = [cluster_id for cluster_id, in query.with_entities(ClusterModel.id)]
+    return json.dumps(cluster_ids)
 
 
 @app.route('/frame/<int:frame_id>/clusters')
 def clusters(frame_id):
     frame_obj = db.session.query(FrameModel).filter_by(id=frame_id).first()
+    if frame_obj is None:
+        return make_response(('No such frame', 404))
 
     cluster_ids = [cluster.id for cluster in frame_obj.clusters]
     return json.dumps(cluster_ids)
@@ -0,0 +1,197 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import config
+from config import FOLLOW_TARGET_RATE
+
+FRAME_SIZE = 256
+
+DSC_RECORD = """[F{index}]
+Type=double [X,C] width=256 height=256
+"Acq Serie Index" ("Acquisition serie index"):
+u32[1]
+{index}
+
+"Acq Serie Start time" ("Acquisition serie start time"):
+double[1]
+{start:.6f}
+
+"Acq time" ("Acquisition time [s]"):
+double[1]
+{acq_time:.6f}
+
+"ChipboardID" ("Chipboard ID"):
+char[9]
+I08-W0060
+
+"""
+
+
+def synthetic_frames(count, clusters, seed=0):
+    """
+    Text of count distinct .pmf frames, each holding clusters dots, blobs and tracks at
+    random positions.
+
+    :param count:
+    :param clusters:
+    :param seed:
+    :return:
+    """
+    rng = np.random.RandomState(seed)
+    frames = []
+
+    for _ in range(count):
+        frame = np.zeros((FRAME_SIZE, FRAME_SIZE), dtype=np.int64)
+
+        for k in range(clusters):
+            row, col = rng.randint(8, FRAME_SIZE - 40, size=2)
+            kind = k % 3
+            if kind == 0:
+                frame[row, col] = rng.randint(1, 30)
+            elif kind == 1:
+                frame[row:row + 3, col:col + 3] = rng.randint(1, 300, size=(3, 3))
+            else:
+                length = rng.randint(10, 30)
+                frame[row + np.arange(length) // 3, col + np.arange(length)] = rng.randint(1, 60, size=length)
+
+        frames.append(''.join(' '.join(str(v) for v in line) + '\n' for line in frame))
+
+    return frames
+
+
+def write_acquisition(filename, frames, count, rate, started):
+    """
+    Append count frames to filename and its .dsc at rate frames per second, or as fast as
+    possible when rate is 0, like a detector recording an acquisition.
+
+    :param filename:
+    :param frames: Frame texts written in turn.
+    :param count:
+    :param rate:
+    :param started: Event set once the first frame has been written.
+    :return:
+    """
+    with open(filename, 'a') as pmf_file, open(filename + '.dsc', 'a') as dsc_file:
+        t0 = time.time()
+
+        for index in range(count):
+            if rate:
+                delay = t0 + index / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            pmf_file.write(frames[index % len(frames)])
+            dsc_file.write(DSC_RECORD.format(index=index, start=t0, acq_time=1.0 / (rate or FOLLOW_TARGET_RATE)))
+            pmf_file.flush()
+            dsc_file.flush()
+            started.set()
+
+
+def wait_for_frames(database, filename, count, timeout):
+    """
+    Poll the database until count frames of the acquisition of filename are committed and
+    return the time that happened, or None after timeout seconds.
+
+    :param database:
+    :param filename:
+    :param count:
+    :param timeout:
+    :return:
+    """
+    deadline = time.time() + timeout
+    connection = sqlite3.connect(database, timeout=timeout)
+
+    try:
+        while time.time() < deadline:
+            try:
+                committed = connection.execute("SELECT COUNT(*) FROM frame WHERE acquisition_id = "
+                                               "(SELECT MAX(id) FROM acquisition WHERE name = ?)",
+                                               (filename,)).fetchone()[0]
+            except sqlite3.OperationalError:
+                committed = 0
+            if committed >= count:
+                return time.time()
+            time.sleep(0.01)
+    finally:
+        connection.close()
+
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the frame rate follow mode sustains on a growing "
+                                                 "synthetic acquisition.")
+    parser.add_argument('--frames', type=int, default=900, help="frames to record")
+    parser.add_argument('--rate', type=float, default=FOLLOW_TARGET_RATE,
+                        help="frames per second to record at, 0 records as fast as possible")
+    parser.add_argument('--clusters', type=int, default=10, help="clusters per frame")
+    parser.add_argument('--database', default=None,
+                        help="run against a copy of this database to include the cost of its size")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp()
+    database = os.path.join(workdir, 'benchmark.db')
+    if args.database is not None:
+        shutil.copy(args.database, database)
+
+    # The models bind their engine on import, so point them at the scratch database first.
+    config.DATABASE_URI = 'sqlite:///' + database
+    from models import Base, engine, create_spatial_index, migrate_database
+    from pmf import Acquisition, follow_into_database
+
+    if str(engine.url) != config.DATABASE_URI:
+        raise RuntimeError("models was imported before the benchmark database was set up")
+
+    Base.metadata.create_all(engine)
+    migrate_database(engine)
+    create_spatial_index(engine)
+
+    try:
+        filename = os.path.join(workdir, 'benchmark.pmf')
+        with open(filename + '.dsc', 'w') as dsc_file:
+            dsc_file.write("A000000001\n")
+        open(filename, 'w').close()
+
+        frames = synthetic_frames(16, args.clusters)
+        started = threading.Event()
+        writer = threading.Thread(target=write_acquisition,
+                                  args=(filename, frames, args.frames, args.rate, started))
+        committed = {}
+        record_duration = args.frames / args.rate if args.rate else 0
+        monitor = threading.Thread(target=lambda: committed.update(
+            time=wait_for_frames(database, filename, args.frames, record_duration + 120)))
+
+        writer.start()
+        started.wait()
+        t0 = time.time()
+        monitor.start()
+        follow_into_database(Acquisition(filename, follow=True), idle_timeout=1.0)
+        writer.join()
+        monitor.join()
+    finally:
+        shutil.rmtree(workdir)
+
+    if committed.get('time') is None:
+        print("follow: not every frame was committed")
+        return 1
+
+    duration = committed['time'] - t0
+    rate = args.frames / duration
+    target = args.rate or FOLLOW_TARGET_RATE
+    print("follow: {} frames in {:.2f}s, {:.1f} frames/s (target {:.1f} frames/s)".format(
+        args.frames, duration, rate, target))
+
+    # Recording at the target rate bounds what can be ingested, allow for the commit delay.
+    return 0 if rate >= 0.9 * target else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+import subprocess
+import sys
+import time
+
+from config import IMPORT_TIME_BUDGET
+
+# Modules whose cold import is on the start up path of a web worker or an ingest run.
+ENTRY_POINTS = ('app', 'ingest')
+
+
+def cold_import_time(module):
+    """
+    Time importing module in a fresh interpreter, including interpreter start up.
+
+    :param module:
+    :return:
+    """
+    t0 = time.time()
+    subprocess.check_call([sys.executable, '-c', 'import {}'.format(module)])
+    return time.time() - t0
+
+
+def slowest_imports(module, count=10):
+    """
+    The packages that contribute most to importing module, as reported by -X importtime.
+
+    :param module:
+    :param count:
+    :return:
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    timings = []
+
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        timings.append((int(parts[1]), parts[2].strip()))
+
+    return sorted(timings, reverse=True)[:count]
+
+
+if __name__ == '__main__':
+    failed = False
+
+    for module in ENTRY_POINTS:
+        duration = cold_import_time(module)
+        print("import {}: {:.2f}s (budget {:.2f}s)".format(module, duration, IMPORT_TIME_BUDGET))
+
+        if duration > IMPORT_TIME_BUDGET:
+            failed = True
+            for cumulative, name in slowest_imports(module):
+                print("    {:>8.3f}s {}".format(cumulative / 1e6, name))
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,160 @@
+import json
+import pickle
+
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+from config import TRACK_CLASSIFIER
+from models import ClusterModel, FrameModel
+
+
+TRACK_CLASSES = ('dot', 'small_blob', 'heavy_blob', 'straight_track', 'curly_track')
+
+# Columns of the feature matrix handed to the classifier, one row per cluster.
+FEATURES = ('area', 'eccentricity', 'solidity', 'track_length', 'max_intensity', 'moments_hu_0')
+
+
+class TrackClassifier(BaseEstimator, ClassifierMixin):
+    """
+    Rule based classification of cluster morphology. It follows the scikit-learn estimator
+    interface so a trained model can be used in its place through TRACK_CLASSIFIER.
+
+    :param dot_area: Clusters with at most this many pixels are dots.
+    :param curly_solidity: Larger clusters below this solidity are curly tracks.
+    :param straight_eccentricity: Larger clusters with at least this eccentricity are straight tracks.
+    :param heavy_intensity: Remaining clusters reaching this max intensity are heavy blobs.
+    """
+    def __init__(self, dot_area=4, curly_solidity=0.6, straight_eccentricity=0.95, heavy_intensity=200):
+        self.dot_area = dot_area
+        self.curly_solidity = curly_solidity
+        self.straight_eccentricity = straight_eccentricity
+        self.heavy_intensity = heavy_intensity
+
+    def fit(self, X, y=None):
+        self.classes_ = np.array(TRACK_CLASSES)
+        return self
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64).reshape(-1, len(FEATURES))
+        area, eccentricity, solidity, _, max_intensity, _ = X.T
+
+        conditions = [area <= self.dot_area,
+                      solidity < self.curly_solidity,
+                      eccentricity >= self.straight_eccentricity,
+                      max_intensity >= self.heavy_intensity]
+        choices = ['dot', 'curly_track', 'straight_track', 'heavy_blob']
+
+        return np.select(conditions, choices, default='small_blob')
+
+
+def load_classifier(path=TRACK_CLASSIFIER):
+    """
+    Load a pickled scikit-learn classifier trained on FEATURES, or the rule based
+    TrackClassifier if no path is given.
+
+    :param path:
+    :return:
+    """
+    if path is None:
+        return TrackClassifier().fit(None)
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+_classifier = None
+
+
+def default_classifier():
+    global _classifier
+
+    if _classifier is None:
+        _classifier = load_classifier()
+    return _classifier
+
+
+def table_features(table):
+    """
+    Feature matrix of all clusters in a ClusterTable.
+
+    :param table:
+    :return:
+    """
+    if len(table) == 0:
+        return np.empty((0, len(FEATURES)))
+
+    return np.column_stack([table.columns['area'],
+                            table.columns['eccentricity'],
+                            table.columns['solidity'],
+                            table.track_length,
+                            table.columns['max_intensity'],
+                            np.asarray(table.columns['moments_hu'])[:, 0]])
+
+
+def classify_table(table, classifier=None):
+    """
+    Classify every cluster of a ClusterTable in one vectorized call.
+
+    :param table:
+    :param classifier:
+    :return: Array of class names, one per cluster.
+    """
+    if len(table) == 0:
+        return np.empty(0, dtype=object)
+
+    if classifier is None:
+        classifier = default_classifier()
+    return np.asarray(classifier.predict(_fill_missing(table_features(table))), dtype=object)
+
+
+def _fill_missing(X):
+    # Clusters with less than two intersections have no track length and older rows may lack
+    # other features. scikit-learn models reject NaN, so missing features are given as 0.
+    X = np.array(X, dtype=np.float64)
+    X[np.isnan(X)] = 0
+    return X
+
+
+def classify_acquisition(session, acquisition_id, classifier=None, batch_size=100000):
+    """
+    Classify the clusters of an acquisition that was ingested without track classes. Rows
+    are read batch_size at a time in id order, and the area of rows from before the column
+    existed is taken from their coords.
+
+    :param session:
+    :param acquisition_id:
+    :param classifier:
+    :param batch_size:
+    :return:
+    """
+    if classifier is None:
+        classifier = default_classifier()
+
+    query = session.query(ClusterModel.id, ClusterModel.area, ClusterModel.eccentricity,
+                          ClusterModel.solidity, ClusterModel.track_length,
+                          ClusterModel.max_intensity, ClusterModel.moments_hu, ClusterModel.coords) \
+        .join(FrameModel) \
+        .filter(FrameModel.acquisition_id == acquisition_id) \
+        .filter(ClusterModel.track_class.is_(None)) \
+        .order_by(ClusterModel.id)
+    last_id = None
+
+    while True:
+        batch_query = query if last_id is None else query.filter(ClusterModel.id > last_id)
+        batch = batch_query.limit(batch_size).all()
+        if not batch:
+            return
+
+        X = _fill_missing([_row_features(row) for row in batch])
+        classes = classifier.predict(X)
+
+        session.bulk_update_mappings(ClusterModel, [{'id': row.id, 'track_class': str(track_class)}
+                                                    for row, track_class in zip(batch, classes)])
+        last_id = batch[-1].id
+
+
+def _row_features(row):
+    area = row.area if row.area is not None else len(json.loads(row.coords))
+    moments_hu = json.loads(row.moments_hu) if row.moments_hu is not None else [None]
+
+    return [area, row.eccentricity, row.solidity, row.track_length, row.max_intensity, moments_hu[0]]
@@ -0,0 +1,180 @@
+from collections import deque
+
+from config import EVENT_WINDOW, EVENT_MARGIN
+from models import EventModel, ClusterModel
+
+
+class ClusterLinker:
+    """
+    Streaming linker for clusters in nearby frames. Each frame's cluster bounding boxes are
+    kept in a spatial hash while the frame is within window frames of the newest one, and a
+    cluster is linked to every cluster in those frames whose bounding box leaves a gap of at
+    most margin pixels to its own, measured between their nearest pixels. Linked clusters
+    form groups via union-find. A group is returned once its newest cluster has left the
+    window, as nothing can be linked to it after that.
+
+    :param window: How many frames back a cluster can be linked.
+    :param margin: Largest gap in pixels between linked bounding boxes.
+    :param cell_size: Size in pixels of the spatial hash cells.
+    """
+    def __init__(self, window=EVENT_WINDOW, margin=EVENT_MARGIN, cell_size=16):
+        self.window = window
+        self.margin = margin
+        self.cell_size = cell_size
+        self.frame_index = 0
+        self._frames = deque()
+        self._parent = {}
+        self._newest = {}
+        self._members = {}
+
+    def add_frame(self, frame_key, cluster_keys, bboxes):
+        """
+        Add the clusters of the next frame.
+
+        :param frame_key: Identifies the frame in the returned groups.
+        :param cluster_keys: One key per cluster, unique across frames.
+        :param bboxes: (min_row, min_col, max_row, max_col) per cluster.
+        :return: Groups of two or more linked clusters that are now complete, each a list of
+            (frame_key, cluster_key) in frame order.
+        """
+        index = self.frame_index
+        self.frame_index += 1
+        cells = {}
+
+        for key, bbox in zip(cluster_keys, bboxes):
+            bbox = tuple(int(v) for v in bbox)
+            self._parent[key] = key
+            self._newest[key] = index
+            self._members[key] = [(index, frame_key, key)]
+
+            for previous in self._frames:
+                for other in self._candidates(previous, bbox):
+                    self._union(key, other)
+
+            for cell in self._cells(bbox, 0):
+                cells.setdefault(cell, []).append((key, bbox))
+
+        self._frames.append((index, cluster_keys, cells))
+
+        complete = []
+        while self._frames and self._frames[0][0] <= index - self.window:
+            complete.extend(self._evict(self._frames.popleft()))
+        return complete
+
+    def finish(self):
+        """
+        Return every remaining group once no more frames will be added.
+
+        :return:
+        """
+        complete = []
+        while self._frames:
+            complete.extend(self._evict(self._frames.popleft()))
+        return complete
+
+    def _cells(self, bbox, margin):
+        min_row, min_col, max_row, max_col = bbox
+        size = self.cell_size
+
+        for row in range((min_row - margin) // size, (max_row - 1 + margin) // size + 1):
+            for col in range((min_col - margin) // size, (max_col - 1 + margin) // size + 1):
+                yield row, col
+
+    def _candidates(self, frame, bbox):
+        _, _, cells = frame
+        min_row, min_col, max_row, max_col = bbox
+        margin = self.margin
+        seen = set()
+
+        for cell in self._cells(bbox, margin):
+            for other, (o_min_row, o_min_col, o_max_row, o_max_col) in cells.get(cell, ()):
+                if other in seen:
+                    continue
+                seen.add(other)
+
+                if min_row - margin < o_max_row and o_min_row < max_row + margin and \
+                        min_col - margin < o_max_col and o_min_col < max_col + margin:
+                    yield other
+
+    def _find(self, key):
+        root = key
+        while self._parent[root] != root:
+            root = self._parent[root]
+
+        while self._parent[key] != root:
+            self._parent[key], key = root, self._parent[key]
+        return root
+
+    def _union(self, a, b):
+        a = self._find(a)
+        b = self._find(b)
+        if a == b:
+            return
+
+        if len(self._members[a]) < len(self._members[b]):
+            a, b = b, a
+        self._parent[b] = a
+        self._newest[a] = max(self._newest[a], self._newest.pop(b))
+        self._members[a].extend(self._members.pop(b))
+
+    def _evict(self, frame):
+        index, cluster_keys, _ = frame
+        complete = []
+
+        for key in cluster_keys:
+            # Already removed along with a group completed earlier in this loop.
+            if key not in self._parent:
+                continue
+
+            root = self._find(key)
+            if self._newest[root] != index:
+                continue
+
+            members = self._members.pop(root)
+            del self._newest[root]
+            for _, _, member in members:
+                del self._parent[member]
+
+            if len(members) > 1:
+                members.sort(key=lambda member: member[0])
+                complete.append([(frame_key, member) for _, frame_key, member in members])
+
+        return complete
+
+
+class EventRecorder:
+    """
+    Runs a ClusterLinker over frames as they are written to the database and stores the
+    linked groups as events. Frames must have been flushed so their ids are known.
+    """
+    def __init__(self, session, acquisition_id, linker=None):
+        self.session = session
+        self.acquisition_id = acquisition_id
+        self.linker = linker if linker is not None else ClusterLinker()
+        self.events = 0
+
+    def add(self, db_frame):
+        clusters = db_frame.clusters
+        bboxes = [(c.min_row, c.min_col, c.max_row, c.max_col) for c in clusters]
+
+        self._store(self.linker.add_frame(db_frame.id, [c.id for c in clusters], bboxes))
+
+    def finish(self):
+        self._store(self.linker.finish())
+
+    def _store(self, groups):
+        if not groups:
+            return
+
+        # One flush for the new events and one executemany for their clusters per frame.
+        events = [EventModel(acquisition_id=self.acquisition_id,
+                             first_frame_id=members[0][0],
+                             last_frame_id=members[-1][0],
+                             cluster_count=len(members)) for members in groups]
+        self.session.add_all(events)
+        self.session.flush()
+
+        self.session.bulk_update_mappings(ClusterModel, [{'id': cluster_id, 'event_id': event.id}
+                                                         for event, members in zip(events, groups)
+                                                         for _, cluster_id in members])
+        self.events += len(events)
@@ -1 +1,38 @@
-DATABASE_URI = 'sqlite:///database.db'
\ No newline at end of file
+DATABASE_URI = 'sqlite:///database.db'
+
+# Log every SQL statement issued through models.engine.
+DATABASE_ECHO = False
+
+# When False only the pixel coordinates of each cluster are stored and the
+# image, filled_image, convex_image and intensity_image columns are derived
+# on demand from the coords and the frame data.
+STORE_CLUSTER_IMAGES = True
+
+# Number of clusters whose derived images are kept in memory.
+DERIVED_IMAGE_CACHE_SIZE = 256
+
+# Path to a pickled scikit-learn classifier over classify.FEATURES used to assign track
+# classes at ingest. The rule based classify.TrackClassifier is used when None.
+TRACK_CLASSIFIER = None
+
+# Ingest stores cumulative hit map images every HITMAP_CHECKPOINT frames, so the
+# integrated image of any frame range is built from two checkpoints and at most
+# 2 * (HITMAP_CHECKPOINT - 1) frames.
+HITMAP_CHECKPOINT = 32
+
+# While follow mode falls behind a recording, frames are committed together at most this
+# many seconds after the first of them instead of one commit per frame.
+FOLLOW_COMMIT_INTERVAL = 0.5
+
+# Frame rate follow mode has to sustain, checked by benchmark_follow.py.
+FOLLOW_TARGET_RATE = 45.0
+
+# Cold start budget in seconds for importing the web app and the ingest entry point,
+# checked by benchmark_imports.py.
+IMPORT_TIME_BUDGET = 2.0
+
+# Clusters in frames up to EVENT_WINDOW frames apart whose bounding boxes leave a gap of at
+# most EVENT_MARGIN pixels between their nearest pixels are linked in to one event during
+# ingest. With 1 only touching clusters, diagonals included, are linked.
+EVENT_WINDOW = 1
+EVENT_MARGIN = 1
@@ -0,0 +1,201 @@
+import re
+
+import numpy as np
+
+
+FRAME_MARKER = re.compile(r'^\[F(\d+)\]$')
+FIELD_NAME = re.compile(r'^"(.*)"\s\("(.*)"\):$')
+FIELD_TYPE = re.compile(r'^(\w+)\[(\d+)\]$')
+
+# Pixet value types that can be stored in a typed column, anything else is kept as text.
+COLUMN_TYPES = {
+    'double': np.float64,
+    'float': np.float64,
+    'i8': np.int64,
+    'i16': np.int64,
+    'i32': np.int64,
+    'i64': np.int64,
+    'u8': np.int64,
+    'u16': np.int64,
+    'u32': np.int64,
+    'u64': np.uint64,
+}
+
+
+class DscSchemaError(Exception):
+    pass
+
+
+def _read_field(lines, i):
+    """
+    Read the field starting at lines[i] and return its name, type and value.
+    """
+    match = FIELD_NAME.match(lines[i].strip())
+    type_match = FIELD_TYPE.match(lines[i + 1].strip())
+
+    if type_match is None:
+        raise DscSchemaError("Field \"{}\" has no type".format(match.group(1)))
+
+    field_type = type_match.group(1) if type_match.group(2) == '1' else 'text'
+
+    return match.group(1), field_type, lines[i + 2].strip()
+
+
+class DscParser:
+    """
+    Incremental .dsc parser. Complete lines are fed in as they become available and finished
+    frame records are appended to records. The field schema is taken from the first frame
+    record and every following record must match it.
+    """
+    def __init__(self, name='.dsc'):
+        self.name = name
+        self.acq = None
+        self.schema = None
+        self.records = []
+        self._record = None
+        self._lines = []
+
+    def feed(self, lines):
+        self._lines.extend(lines)
+        i = 0
+
+        while i < len(self._lines):
+            line = self._lines[i].strip()
+
+            if self.acq is None:
+                self.acq = line
+                i += 1
+                continue
+
+            if FRAME_MARKER.match(line):
+                self._finish_record()
+                self._record = []
+                i += 1
+                continue
+
+            if not FIELD_NAME.match(line):
+                i += 1
+                continue
+
+            if self._record is None:
+                if self.records:
+                    raise DscSchemaError("Frame {} in {} has more fields than the schema of the first "
+                                         "frame".format(len(self.records) - 1, self.name))
+                i += 1
+                continue
+
+            # Wait for the type and value lines of a field that is still being written.
+            if i + 2 >= len(self._lines):
+                break
+
+            name, field_type, value = _read_field(self._lines, i)
+            self._add_field(name, field_type, value)
+            i += 3
+
+        del self._lines[:i]
+
+    def close(self):
+        self._finish_record()
+
+    def description(self, index):
+        """
+        Description of a single frame as a dict of the values as written in the file.
+
+        :param index:
+        :return:
+        """
+        return dict(zip([name for name, _ in self.schema], self.records[index]))
+
+    def descriptions(self):
+        """
+        Convert the parsed records in to typed per field columns.
+
+        :return:
+        """
+        columns = {}
+
+        for j, (name, field_type) in enumerate(self.schema or []):
+            values = [record[j] for record in self.records]
+            dtype = COLUMN_TYPES.get(field_type)
+
+            if dtype is None:
+                columns[name] = np.array(values, dtype=object)
+                continue
+
+            try:
+                columns[name] = np.array(values).astype(dtype)
+            except ValueError:
+                raise DscSchemaError("Field \"{}\" in {} has non numeric values".format(name, self.name))
+
+        return FrameDescriptions(self.acq, self.schema, columns, self.records)
+
+    def _add_field(self, name, field_type, value):
+        index = len(self._record)
+
+        if self.schema is not None and (index >= len(self.schema) or self.schema[index] != (name, field_type)):
+            expected = self.schema[index] if index < len(self.schema) else None
+            raise DscSchemaError("Frame {} in {} does not match the schema of the first frame: expected "
+                                 "field {} got {}".format(len(self.records), self.name, expected,
+                                                          (name, field_type)))
+
+        self._record.append((name, field_type, value))
+
+        # Once the schema is known a record is finished as soon as it has all of its fields.
+        if self.schema is not None and len(self._record) == len(self.schema):
+            self._finish_record()
+
+    def _finish_record(self):
+        if self._record is None:
+            return
+
+        record_schema = [(name, field_type) for name, field_type, _ in self._record]
+
+        if self.schema is None:
+            self.schema = record_schema
+        elif record_schema != self.schema:
+            raise DscSchemaError("Frame {} in {} does not match the schema of the first frame: "
+                                 "expected {}, got {}".format(len(self.records), self.name,
+                                                              self.schema, record_schema))
+
+        self.records.append([value for _, _, value in self._record])
+        self._record = None
+
+
+class FrameDescriptions:
+    """
+    Frame descriptions of an acquisition stored as one array per field.
+    """
+    def __init__(self, acq, schema, columns, records):
+        self.acq = acq
+        self.schema = schema
+        self.columns = columns
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    description = DscParser.description
+
+
+def parse_dsc(filename):
+    """
+    Parse all frame descriptions of a .dsc file in a single pass.
+
+    :param filename:
+    :return:
+    """
+    parser = DscParser(filename)
+
+    with open(filename, 'r') as dsc_file:
+        parser.feed(dsc_file.read().splitlines())
+    parser.close()
+
+    if parser.acq is None:
+        raise DscSchemaError("{} is empty".format(filename))
+    if not parser.records:
+        raise DscSchemaError("No frame records found in {}".format(filename))
+
+    return parser.descriptions()
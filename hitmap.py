@@ -0,0 +1,154 @@
+import io
+import json
+
+import numpy as np
+
+from config import HITMAP_CHECKPOINT
+from models import FrameModel, HitMapModel
+
+
+FRAME_SHAPE = (256, 256)
+
+
+def pack_images(hits, values):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, hits=hits, values=values)
+    return buffer.getvalue()
+
+
+def unpack_images(data):
+    with np.load(io.BytesIO(data)) as images:
+        return images['hits'], images['values']
+
+
+class HitMapAccumulator:
+    """
+    Running hit count and summed value images of an acquisition, emitting a checkpoint every
+    HITMAP_CHECKPOINT frames while frames are ingested in order.
+    """
+    def __init__(self, checkpoint=HITMAP_CHECKPOINT):
+        self.checkpoint = checkpoint
+        self.frame_count = 0
+        self.hits = np.zeros(FRAME_SHAPE, dtype=np.int32)
+        self.values = np.zeros(FRAME_SHAPE, dtype=np.float64)
+
+    def add(self, frame, frame_id):
+        """
+        Add a frame and return a HitMapModel if this frame completes a checkpoint.
+
+        :param frame:
+        :param frame_id: Database id of the frame, stored with the checkpoint it completes.
+        :return:
+        """
+        return self.add_sparse(frame_id, frame.arr.row, frame.arr.col, frame.arr.data)
+
+    def add_sparse(self, frame_id, rows, cols, data):
+        _accumulate(self.hits, self.values, rows, cols, data)
+        self.frame_count += 1
+
+        if self.frame_count % self.checkpoint == 0:
+            return HitMapModel(frame_count=self.frame_count, last_frame_id=frame_id,
+                               images=pack_images(self.hits, self.values))
+        return None
+
+
+def _triples(frame_data):
+    triples = np.array(json.loads(frame_data)).reshape(-1, 3)
+    return triples[:, 0], triples[:, 1], triples[:, 2]
+
+
+def _accumulate(hits, values, rows, cols, data):
+    # Pixels are unique within a frame so plain fancy indexing is safe here.
+    rows = np.asarray(rows, dtype=np.intp)
+    cols = np.asarray(cols, dtype=np.intp)
+    hits[rows, cols] += 1
+    values[rows, cols] += data
+
+
+def _cumulative(session, acquisition_id, frame_count):
+    """
+    Hit and value images summed over frames [0, frame_count) of an acquisition, built from
+    the closest checkpoint at or below frame_count plus the frames after it.
+    """
+    hits = np.zeros(FRAME_SHAPE, dtype=np.int32)
+    values = np.zeros(FRAME_SHAPE, dtype=np.float64)
+
+    checkpoint = session.query(HitMapModel) \
+        .filter(HitMapModel.acquisition_id == acquisition_id) \
+        .filter(HitMapModel.frame_count <= frame_count) \
+        .filter(HitMapModel.last_frame_id.isnot(None)) \
+        .order_by(HitMapModel.frame_count.desc()) \
+        .first()
+
+    start = 0
+    frames = session.query(FrameModel.frame_data) \
+        .filter(FrameModel.acquisition_id == acquisition_id)
+
+    if checkpoint is not None:
+        hits, values = unpack_images(checkpoint.images)
+        hits = hits.copy()
+        values = values.copy()
+        start = checkpoint.frame_count
+        # Seek past the checkpoint by id rather than offset so earlier frames are not stepped through.
+        frames = frames.filter(FrameModel.id > checkpoint.last_frame_id)
+
+    if frame_count > start:
+        frames = frames.order_by(FrameModel.id).limit(frame_count - start)
+
+        for frame_data, in frames:
+            _accumulate(hits, values, *_triples(frame_data))
+
+    return hits, values
+
+
+def integrated_image(session, acquisition_id, start, stop, kind='hits'):
+    """
+    Integrated image of frames [start, stop) of an acquisition, counted from the first frame.
+    kind selects the number of frames each pixel was hit in ('hits') or the summed pixel
+    values ('values').
+
+    :param session:
+    :param acquisition_id:
+    :param start:
+    :param stop:
+    :param kind:
+    :return:
+    """
+    if kind not in ('hits', 'values'):
+        raise ValueError("Unknown hit map kind {}".format(kind))
+    if not 0 <= start <= stop:
+        raise ValueError("Invalid frame range [{}, {})".format(start, stop))
+
+    start_hits, start_values = _cumulative(session, acquisition_id, start)
+    stop_hits, stop_values = _cumulative(session, acquisition_id, stop)
+
+    if kind == 'hits':
+        return stop_hits - start_hits
+    return stop_values - start_values
+
+
+def index_hitmaps(session, acquisition_id, checkpoint=HITMAP_CHECKPOINT):
+    """
+    Build the hit map checkpoints of an acquisition that was ingested without them.
+
+    :param session:
+    :param acquisition_id:
+    :param checkpoint:
+    :return:
+    """
+    session.query(HitMapModel).filter(HitMapModel.acquisition_id == acquisition_id).delete()
+
+    accumulator = HitMapAccumulator(checkpoint)
+    checkpoints = []
+    frames = session.query(FrameModel.id, FrameModel.frame_data) \
+        .filter(FrameModel.acquisition_id == acquisition_id) \
+        .order_by(FrameModel.id)
+
+    for frame_id, frame_data in frames.yield_per(checkpoint):
+        hitmap = accumulator.add_sparse(frame_id, *_triples(frame_data))
+        if hitmap is not None:
+            checkpoints.append(hitmap)
+
+    for hitmap in checkpoints:
+        hitmap.acquisition_id = acquisition_id
+        session.add(hitmap)
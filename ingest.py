@@ -0,0 +1,367 @@
+import argparse
+import os
+import pickle
+import resource
+import tempfile
+import threading
+
+from collections import deque
+
+import numpy as np
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, engine, AcquisitionModel, FrameModel, ClusterModel, EventModel, HitMapModel, \
+    create_spatial_index, migrate_database
+from coincidence import EventRecorder
+from hitmap import HitMapAccumulator
+from spatial import acquisition_start, index_frame, unindex_acquisition
+
+
+_DONE = object()
+
+
+class IngestAborted(Exception):
+    pass
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes. Falls back to the peak RSS where /proc is
+    not available.
+
+    :return:
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+
+def frame_nbytes(frame):
+    """
+    Approximate memory held by a Frame and its cluster table.
+
+    :param frame:
+    :return:
+    """
+    nbytes = frame.arr.data.nbytes + frame.arr.row.nbytes + frame.arr.col.nbytes
+    table = frame.clusters
+
+    for column in table.columns.values():
+        if isinstance(column, np.ndarray):
+            nbytes += column.nbytes
+    for array in (table.min_area_box, table.intersections, table.track_length, table.track_class,
+                  table.offsets, table.coords, table.intensities):
+        nbytes += array.nbytes
+
+    return nbytes
+
+
+def model_nbytes(db_frame):
+    """
+    Approximate memory held by a FrameModel and its clusters while they wait in the session,
+    counting the text columns which hold the JSON encoded frame data and cluster images.
+
+    :param db_frame:
+    :return:
+    """
+    nbytes = 0
+    for instance in [db_frame] + list(db_frame.clusters):
+        for value in vars(instance).values():
+            if isinstance(value, str):
+                nbytes += len(value)
+    return nbytes
+
+
+class StageStats:
+    """
+    Frames handled by an ingest stage and the most bytes of frame data the stage held at once.
+    The stages are threads of a single process, so the peak RSS recorded alongside is that of
+    the whole process while the stage was working, not of the stage itself.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.peak_bytes = 0
+        self.peak_process_rss = 0
+
+    def record(self, nbytes):
+        self.items += 1
+        self.peak_bytes = max(self.peak_bytes, nbytes)
+        self.peak_process_rss = max(self.peak_process_rss, current_rss())
+
+    def __repr__(self):
+        return "{}: {} frames, peak {:.1f} MiB held, process peak RSS {:.1f} MiB".format(
+            self.name, self.items, self.peak_bytes / 2 ** 20, self.peak_process_rss / 2 ** 20)
+
+
+class BoundedQueue:
+    """
+    FIFO between two ingest stages holding at most max_items items and max_bytes bytes.
+    A full queue blocks the producer, unless spill_dir is given in which case items that do
+    not fit are pickled to disk and read back in order by the consumer.
+    """
+    def __init__(self, max_items, max_bytes, spill_dir=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spilled = 0
+        self._items = deque()
+        self._bytes = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, item, nbytes):
+        with self._cond:
+            if self._closed:
+                raise IngestAborted()
+
+            if self.spill_dir is not None and self._is_full(nbytes):
+                self._items.append((self._spill(item), 0, True))
+                self.spilled += 1
+                self._cond.notify_all()
+                return
+
+            while self._is_full(nbytes) and not self._closed:
+                self._cond.wait()
+
+            if self._closed:
+                raise IngestAborted()
+
+            self._items.append((item, nbytes, False))
+            self._bytes += nbytes
+            self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+
+            item, nbytes, spilled = self._items.popleft()
+            self._bytes -= nbytes
+            self._cond.notify_all()
+
+        return self._unspill(item) if spilled else item
+
+    def finish(self):
+        """
+        Tell the consumer that no more items will follow.
+        """
+        with self._cond:
+            self._items.append((_DONE, 0, False))
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        Make producers stop with IngestAborted, used when a downstream stage ends early.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _is_full(self, nbytes):
+        # An empty queue always accepts an item so a single large frame can not deadlock.
+        if not self._items:
+            return False
+        return len(self._items) >= self.max_items or self._bytes + nbytes > self.max_bytes
+
+    def _spill(self, item):
+        fd, path = tempfile.mkstemp(suffix='.frame', dir=self.spill_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return path
+
+    @staticmethod
+    def _unspill(path):
+        with open(path, 'rb') as f:
+            item = pickle.load(f)
+        os.remove(path)
+        return item
+
+
+def _run_stage(stats, source, target, work, errors, upstream):
+    """
+    Apply work to every item of source and put the result on target. Errors are recorded
+    and end the pipeline.
+    """
+    try:
+        for item in source:
+            result = work(item)
+            nbytes = frame_nbytes(result)
+            stats.record(nbytes)
+            target.put(result, nbytes)
+    except IngestAborted:
+        if upstream is not None:
+            upstream.close()
+    except BaseException as e:
+        errors.append(e)
+        if upstream is not None:
+            upstream.close()
+    finally:
+        target.finish()
+
+
+def _drain(queue):
+    while True:
+        item = queue.get()
+        if item is _DONE:
+            return
+        yield item
+
+
+def stream_into_database(acq, memory_budget=256 * 2 ** 20, queue_size=64, batch_size=100, spill_dir=None):
+    """
+    Insert an acquisition with separate parse, cluster and write stages connected by bounded
+    queues. memory_budget is split evenly between the frames waiting in the two queues and
+    the frames the writer has added to the session but not yet committed. The writer commits
+    every batch_size frames, or sooner once its share of the budget is used, and adds each
+    committed batch to the spatial index so it can be searched while the rest is written.
+    With spill_dir set, frames that do not fit in the budget are written to disk instead of
+    stalling the earlier stages. If any stage fails, the frames already committed are deleted
+    again so a partial acquisition is never left behind.
+
+    :param acq:
+    :param memory_budget:
+    :param queue_size:
+    :param batch_size:
+    :param spill_dir:
+    :return: Per stage statistics.
+    """
+    # pmf pulls in cv2 and skimage, so it is only imported once there is work to do.
+    from pmf import frame_to_model
+
+    parsed = BoundedQueue(queue_size, memory_budget // 3, spill_dir)
+    clustered = BoundedQueue(queue_size, memory_budget // 3, spill_dir)
+    stats = {name: StageStats(name) for name in ('parse', 'cluster', 'write')}
+    errors = []
+
+    def cluster(frame):
+        frame.cluster()
+        return frame
+
+    stages = [
+        threading.Thread(target=_run_stage,
+                         args=(stats['parse'], acq.read_frames(), parsed, lambda frame: frame, errors, None)),
+        threading.Thread(target=_run_stage,
+                         args=(stats['cluster'], _drain(parsed), clustered, cluster, errors, parsed)),
+    ]
+    for stage in stages:
+        stage.daemon = True
+        stage.start()
+
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    acquisition = AcquisitionModel(name=acq.filename)
+    session.add(acquisition)
+    session.commit()
+    acquisition_id = acquisition.id
+    hitmaps = HitMapAccumulator()
+    events = EventRecorder(session, acquisition_id)
+
+    try:
+        batch = []
+        batch_bytes = 0
+        start = None
+
+        for i, frame in enumerate(_drain(clustered)):
+            db_frame = frame_to_model(frame)
+            db_frame.acquisition_id = acquisition_id
+            session.add(db_frame)
+            session.flush()
+            events.add(db_frame)
+            if start is None:
+                start = acquisition_start(session, acquisition_id)
+
+            hitmap = hitmaps.add(frame, db_frame.id)
+            if hitmap is not None:
+                hitmap.acquisition_id = acquisition_id
+                session.add(hitmap)
+
+            batch.append(db_frame.id)
+            batch_bytes += model_nbytes(db_frame)
+            stats['write'].record(batch_bytes)
+
+            if len(batch) >= batch_size or batch_bytes >= memory_budget // 3:
+                _commit_batch(session, batch, start)
+                batch = []
+                batch_bytes = 0
+                print("Inserted frame {}".format(i))
+
+        for stage in stages:
+            stage.join()
+        if errors:
+            raise errors[0]
+
+        events.finish()
+        _commit_batch(session, batch, start)
+    except BaseException:
+        clustered.close()
+        session.rollback()
+        _discard_acquisition(session, acquisition_id)
+        session.commit()
+        raise
+
+    report = list(stats.values())
+    for stage_stats in report:
+        print(stage_stats)
+    if parsed.spilled or clustered.spilled:
+        print("Spilled {} frames to {}".format(parsed.spilled + clustered.spilled, spill_dir))
+
+    return report
+
+
+def _commit_batch(session, frame_ids, start):
+    for frame_id in frame_ids:
+        index_frame(session, frame_id, start)
+    session.commit()
+    # Nothing is read back, so committed frames are dropped instead of kept in the session.
+    session.expunge_all()
+
+
+def _discard_acquisition(session, acquisition_id):
+    """
+    Delete everything an interrupted ingest committed for an acquisition.
+    """
+    frame_ids = session.query(FrameModel.id).filter(FrameModel.acquisition_id == acquisition_id)
+
+    unindex_acquisition(session, acquisition_id)
+    session.query(ClusterModel).filter(ClusterModel.frame_id.in_(frame_ids.subquery())) \
+        .delete(synchronize_session=False)
+    for model in (EventModel, HitMapModel, FrameModel):
+        session.query(model).filter(model.acquisition_id == acquisition_id).delete(synchronize_session=False)
+    session.query(AcquisitionModel).filter(AcquisitionModel.id == acquisition_id).delete(synchronize_session=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cluster a MiniPIX acquisition and insert it in to the database.")
+    parser.add_argument('filename', help=".pmf file, the .dsc file is expected next to it")
+    parser.add_argument('--init-db', action='store_true',
+                        help="create the database tables, or add new columns to existing ones, first")
+    parser.add_argument('--follow', action='store_true', help="follow an acquisition that is still being recorded")
+    parser.add_argument('--poll-interval', type=float, default=0.05, help="seconds between checks for new frames")
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help="stop following once the files have not grown for this many seconds")
+    parser.add_argument('--memory-budget', type=int, default=256, help="MiB of frames in flight between stages")
+    parser.add_argument('--batch-size', type=int, default=100, help="frames per commit")
+    parser.add_argument('--spill-dir', default=None, help="spill frames that exceed the budget to this directory")
+    args = parser.parse_args(argv)
+
+    if args.init_db:
+        Base.metadata.create_all(engine)
+        migrate_database(engine)
+        create_spatial_index(engine)
+
+    from pmf import Acquisition, follow_into_database
+
+    if args.follow:
+        follow_into_database(Acquisition(args.filename, follow=True), args.poll_interval, args.idle_timeout)
+    else:
+        stream_into_database(Acquisition(args.filename), memory_budget=args.memory_budget * 2 ** 20,
+                             batch_size=args.batch_size, spill_dir=args.spill_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,19 @@
+import json
+import threading
+
+from collections import OrderedDict
+
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, Text, ForeignKey, Float
-from sqlalchemy import create_engine
+from sqlalchemy import Column, Integer, Text, ForeignKey, Float, String, LargeBinary
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.ext.hybrid import hybrid_method
-from serialalchemy import Serializable
-from config import DATABASE_URI
+from serialalchemy import Serializable, serializable_property
+from config import DATABASE_URI, DATABASE_ECHO, DERIVED_IMAGE_CACHE_SIZE
+from nputils import sparse_to_dense, coords_to_image, filled_image, convex_image, intensity_image
 Base = declarative_base()
-engine = create_engine(DATABASE_URI, echo=True)
+CLUSTER_RTREE = 'cluster_rtree'
+engine = create_engine(DATABASE_URI, echo=DATABASE_ECHO)
 
 
 class AcquisitionModel(Base):
@@ -15,17 +22,19 @@ class AcquisitionModel(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(Text())
     frames = relationship('FrameModel', back_populates='acquisition')
+    hitmaps = relationship('HitMapModel', back_populates='acquisition')
+    events = relationship('EventModel', back_populates='acquisition')
 
 
 class FrameModel(Base):
     __tablename__ = 'frame'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    acquisition_id = Column(Integer, ForeignKey('acquisition.id'))
+    acquisition_id = Column(Integer, ForeignKey('acquisition.id'), index=True)
     acquisition = relationship('AcquisitionModel', back_populates='frames')
     frame_data = Column(Text())
     acq_time = Column(Float())
-    acq_start = Column(Float())
+    acq_start = Column(Float(), index=True)
     description = Column(Text())
     counts = Column(Integer())
     clusters = relationship('ClusterModel', back_populates='frame')
@@ -35,28 +44,38 @@ class ClusterModel(Base, Serializable):
     __tablename__ = 'cluster'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    frame_id = Column(Integer, ForeignKey('frame.id'))
+    frame_id = Column(Integer, ForeignKey('frame.id'), index=True)
     frame = relationship('FrameModel', back_populates='clusters')
     min_area_box = Column(Text())
     track_length = Column(Float())
+    track_class = Column(String(16), index=True)
+    event_id = Column(Integer, ForeignKey('event.id'), index=True)
+    event = relationship('EventModel', back_populates='clusters')
     intersections = Column(Text())
     region_properties = Column(Text(4294000000))
+    area = Column(Integer())
     bbox = Column(Text())
     bbox_area = Column(Float())
     centroid = Column(Text())
+    centroid_row = Column(Float(), index=True)
+    centroid_col = Column(Float(), index=True)
+    min_row = Column(Integer())
+    min_col = Column(Integer())
+    max_row = Column(Integer())
+    max_col = Column(Integer())
     convex_area = Column(Float())
-    convex_image = Column(Text(4294000000))
+    _convex_image = Column('convex_image', Text(4294000000), info={'serializable': False})
     coords = Column(Text())
     eccentricity = Column(Float())
     equivalent_diameter = Column(Float())
     euler_number = Column(Integer())
     extent = Column(Float())
     filled_area = Column(Integer())
-    filled_image = Column(Text(4294000000))
-    image = Column(Text(4294000000))
+    _filled_image = Column('filled_image', Text(4294000000), info={'serializable': False})
+    _image = Column('image', Text(4294000000), info={'serializable': False})
     inertia_tensor = Column(Text())
     inertia_tensor_eigvals = Column(Text())
-    intensity_image = Column(Text(4294000000))
+    _intensity_image = Column('intensity_image', Text(4294000000), info={'serializable': False})
     label = Column(Integer())
     local_centroid = Column(Integer())
     major_axis_length = Column(Float())
@@ -78,6 +97,140 @@ class ClusterModel(Base, Serializable):
     weighted_moments_hu = Column(Text())
     weighted_moments_normalized = Column(Text())
 
+    # Image columns are left empty when ingest runs with STORE_CLUSTER_IMAGES = False,
+    # in which case they are derived from coords, bbox and the frame data on access.
+    @serializable_property
+    def image(self):
+        if self._image is not None:
+            return self._image
+        return self._derived_images()['image']
+
+    @image.setter
+    def image(self, value):
+        self._image = value
+
+    @serializable_property
+    def filled_image(self):
+        if self._filled_image is not None:
+            return self._filled_image
+        return self._derived_images()['filled_image']
+
+    @filled_image.setter
+    def filled_image(self, value):
+        self._filled_image = value
+
+    @serializable_property
+    def convex_image(self):
+        if self._convex_image is not None:
+            return self._convex_image
+        return self._derived_images()['convex_image']
+
+    @convex_image.setter
+    def convex_image(self, value):
+        self._convex_image = value
+
+    @serializable_property
+    def intensity_image(self):
+        if self._intensity_image is not None:
+            return self._intensity_image
+        return self._derived_images()['intensity_image']
+
+    @intensity_image.setter
+    def intensity_image(self, value):
+        self._intensity_image = value
+
+    def _derived_images(self):
+        images = _derived_image_cache.get(self.id)
+
+        if images is None:
+            images = derive_cluster_images(self.coords, self.bbox, self.frame.frame_data)
+            _derived_image_cache.put(self.id, images)
+
+        return images
+
+
+class HitMapModel(Base):
+    __tablename__ = 'hitmap'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    acquisition_id = Column(Integer, ForeignKey('acquisition.id'), index=True)
+    acquisition = relationship('AcquisitionModel', back_populates='hitmaps')
+    # Number of frames summed, the checkpoint covers frames [0, frame_count) of the acquisition.
+    frame_count = Column(Integer(), index=True)
+    # Id of the last frame summed, frames after the checkpoint are found by id from here.
+    last_frame_id = Column(Integer())
+    # Compressed npz holding the cumulative 'hits' and 'values' images.
+    images = Column(LargeBinary(4294000000))
+
+
+class EventModel(Base):
+    __tablename__ = 'event'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    acquisition_id = Column(Integer, ForeignKey('acquisition.id'), index=True)
+    acquisition = relationship('AcquisitionModel', back_populates='events')
+    first_frame_id = Column(Integer(), index=True)
+    last_frame_id = Column(Integer())
+    cluster_count = Column(Integer())
+    clusters = relationship('ClusterModel', back_populates='event')
+
+
+class DerivedImageCache:
+    """
+    Small LRU of derived cluster images keyed by cluster id. It is shared by the web app's
+    request threads so every access holds a lock.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cluster_id):
+        if cluster_id is None:
+            return None
+
+        with self._lock:
+            images = self._images.get(cluster_id)
+            if images is not None:
+                self._images.move_to_end(cluster_id)
+            return images
+
+    def put(self, cluster_id, images):
+        if cluster_id is None:
+            return
+
+        with self._lock:
+            self._images[cluster_id] = images
+            self._images.move_to_end(cluster_id)
+
+            while len(self._images) > self.size:
+                self._images.popitem(last=False)
+
+
+_derived_image_cache = DerivedImageCache(DERIVED_IMAGE_CACHE_SIZE)
+
+
+def derive_cluster_images(coords, bbox, frame_data):
+    """
+    Recompute the JSON encoded image columns of a cluster from its stored coords and bbox
+    and the sparse data of its frame.
+
+    :param coords:
+    :param bbox:
+    :param frame_data:
+    :return:
+    """
+    bbox = json.loads(bbox)
+    image = coords_to_image(json.loads(coords), bbox)
+    frame = sparse_to_dense(json.loads(frame_data))
+
+    return {
+        'image': json.dumps(image.tolist()),
+        'filled_image': json.dumps(filled_image(image).tolist()),
+        'convex_image': json.dumps(convex_image(image).tolist()),
+        'intensity_image': json.dumps(intensity_image(frame, image, bbox).tolist()),
+    }
+
 
 def get_db_session():
     Session = sessionmaker(bind=engine)
@@ -85,5 +238,53 @@ def get_db_session():
     return session
 
 
+def create_spatial_index(bind):
+    """
+    Create the R*Tree over cluster bounding boxes and frame start times. Only SQLite provides
+    the rtree module, other databases fall back to the indexed numeric columns.
+
+    :param bind:
+    :return:
+    """
+    if bind.dialect.name != 'sqlite':
+        return False
+
+    bind.execute("CREATE VIRTUAL TABLE IF NOT EXISTS {} USING rtree("
+                 "id, min_row, max_row, min_col, max_col, min_time, max_time)".format(CLUSTER_RTREE))
+    return True
+
+
+def migrate_database(bind):
+    """
+    Add the columns and indexes that were added to the models after a database was created.
+    create_all only creates missing tables, so without this every query against an older
+    table fails on the new columns. Running it again does nothing.
+
+    :param bind:
+    :return:
+    """
+    inspector = inspect(bind)
+    preparer = bind.dialect.identifier_preparer
+    tables = set(inspector.get_table_names())
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                bind.execute("ALTER TABLE {} ADD COLUMN {} {}".format(preparer.format_table(table),
+                                                                      preparer.format_column(column),
+                                                                      column.type.compile(dialect=bind.dialect)))
+
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(bind)
+
+
 if __name__ == '__main__':
     Base.metadata.create_all(engine)
+    migrate_database(engine)
+    create_spatial_index(engine)
@@ -12,4 +12,60 @@ def sparse_to_dense(data):
     y = data[:, 1]
     values = data[:, 2]
 
-    return coo_matrix((values, (x, y)), shape=(256, 256)).todense()
\ No newline at end of file
+    return coo_matrix((values, (x, y)), shape=(256, 256)).todense()
+
+
+def coords_to_image(coords, bbox):
+    """
+    Rebuild the binary image of a cluster from its pixel coordinates and bounding box.
+
+    :param coords:
+    :param bbox:
+    :return:
+    """
+    coords = np.array(coords, dtype=int).reshape(-1, 2)
+    min_row, min_col, max_row, max_col = [int(v) for v in bbox]
+
+    image = np.zeros((max_row - min_row, max_col - min_col), dtype=bool)
+    image[coords[:, 0] - min_row, coords[:, 1] - min_col] = True
+
+    return image
+
+
+def filled_image(image):
+    """
+    Binary cluster image with any holes filled, matching skimage's regionprops.
+
+    :param image:
+    :return:
+    """
+    from scipy import ndimage as ndi
+
+    return ndi.binary_fill_holes(image, np.ones((3, 3)))
+
+
+def convex_image(image):
+    """
+    Binary convex hull image of a cluster, matching skimage's regionprops.
+
+    :param image:
+    :return:
+    """
+    # Imported here so that importing models for the web app does not load scikit-image.
+    from skimage.morphology import convex_hull_image
+
+    return convex_hull_image(image)
+
+
+def intensity_image(frame, image, bbox):
+    """
+    Crop the dense frame to the cluster's bounding box and mask out pixels not in the cluster.
+
+    :param frame:
+    :param image:
+    :param bbox:
+    :return:
+    """
+    min_row, min_col, max_row, max_col = [int(v) for v in bbox]
+
+    return np.asarray(frame)[min_row:max_row, min_col:max_col] * image
@@ -1,31 +1,35 @@
 import time
 import os
-import re
 import json
 
 from itertools import islice
-from numpy import array
-from scipy.sparse import coo_matrix
-from scipy.ndimage import label as nlabel
-from scipy.ndimage import find_objects
 
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
+import numpy as np
 import cv2 as cv
-from sklearn.preprocessing import binarize
+from scipy.sparse import coo_matrix
+from scipy.spatial import distance as dist
+from sqlalchemy.orm import sessionmaker
 
 from skimage.measure import label, regionprops
-from skimage.color import label2rgb
 
-from mathutils import *
-from models import *
+from coincidence import EventRecorder
+from hitmap import HitMapAccumulator
+from dsc import parse_dsc, DscParser, DscSchemaError
+from mathutils import order_points, line_intersect, intersections_with_bbox
+from nputils import coords_to_image, filled_image, convex_image
+from models import engine, AcquisitionModel, FrameModel, ClusterModel
+from config import STORE_CLUSTER_IMAGES, FOLLOW_COMMIT_INTERVAL
+from spatial import set_cluster_position, index_acquisition, index_frame, acquisition_start
+
+# Region properties that can be rebuilt from coords and the frame data.
+DERIVED_IMAGE_PROPERTIES = ('image', 'filled_image', 'convex_image', 'intensity_image')
 
 
 class Acquisition:
     FRAME_WIDTH = 256
     FRAME_HEIGHT = 256
 
-    def __init__(self, filename):
+    def __init__(self, filename, follow=False):
         self.filename = filename
         self.dscfilename = filename + '.dsc'
         self._frames = []
@@ -33,11 +37,26 @@ class Acquisition:
         if not (os.path.isfile(self.filename) and os.path.isfile(self.dscfilename)):
             raise Exception("Failed to find file {}".format(self.filename))
 
-        self.dsc_file = open(self.dscfilename, 'r')
-        self.acq = self.dsc_file.readline()
+        # A followed acquisition is still being written so its description is parsed as it grows.
+        if follow:
+            self.descriptions = None
+            self.acq = None
+            return
+
+        self.descriptions = parse_dsc(self.dscfilename)
+        self.acq = self.descriptions.acq
         self.load()
 
     def load(self):
+        for frame in self.read_frames():
+            frame.cluster()
+            yield frame
+
+    def read_frames(self):
+        """
+        Generator over the frames of the acquisition before they are clustered.
+        :return:
+        """
         with open(self.filename, 'r') as pmffile:
             finished = False
             frames = 0
@@ -45,55 +64,81 @@ class Acquisition:
             while not finished:
 
                 data = list(islice(pmffile, self.FRAME_HEIGHT))
-                frame = []
 
                 if not data:
                     finished = True
-                for line in data:
-                    frame.append([float(x) for x in line.split()])
 
-                if len(frame) < 256:
+                if len(data) < self.FRAME_HEIGHT:
                     print("Observed incorrect frame format, skipping...")
                     continue
 
+                if frames >= len(self.descriptions):
+                    raise DscSchemaError("{} has no description for frame {}".format(self.dscfilename, frames))
+
+                frame_dsc = self.descriptions.description(frames)
+                acq_time = self.descriptions['Acq time'][frames]
+                acq_start = self.descriptions['Acq Serie Start time'][frames]
                 frames += 1
                 print("Processing frame {}".format(frames))
-                arr = array(frame)
-                frame_dsc = self._load_frame_description()
-                frame = Frame(arr, frame_dsc)
-                frame.cluster()
-                yield frame
-        self.dsc_file.close()
-
-    def _read_frame_header(self):
-        lines = [self.dsc_file.readline() for _ in range(5)]
-
-        frame_identifier = lines[0]
-        frame_description = lines[1].split()
-        data_type = frame_description[0].split('=')[-1]
-        storage_type = frame_description[1]
-        width = frame_description[2].split('=')[-1]
-        height = frame_description[3].split('=')[-1]
-
-    def _read_frame_field(self):
-        regex = '\"(.*)\"\s\(\"(.*)\"\):'
-        lines = [self.dsc_file.readline() for _ in range(4)]
-        key = re.search(regex, lines[1]).group(1)
-        value = lines[3].strip()
-
-        return key, value
-
-    def _load_frame_description(self):
-        frame_dsc = {}
-        self._read_frame_header()
-
-        for _ in range(13):
-            key, value = self._read_frame_field()
-            frame_dsc[key] = value
-        for _ in range(2):
-            self.dsc_file.readline()
-
-        return frame_dsc
+                yield Frame(self._parse_frame(data), frame_dsc, acq_time, acq_start)
+
+    def follow(self, poll_interval=0.05, idle_timeout=None, yield_idle=False):
+        """
+        Follow a .pmf/.dsc pair that is still being written and yield each frame as soon as
+        both its pixel data and its description are complete. Stops once neither file has
+        grown for idle_timeout seconds, or never if idle_timeout is None. With yield_idle set,
+        None is yielded whenever every complete frame has been yielded and it starts waiting.
+
+        :param poll_interval:
+        :param idle_timeout:
+        :param yield_idle:
+        :return:
+        """
+        parser = DscParser(self.dscfilename)
+        pmf_tail = LineTail(self.filename)
+        dsc_tail = LineTail(self.dscfilename)
+        pending = []
+        frames = 0
+        last_growth = time.time()
+
+        try:
+            while True:
+                pmf_lines = pmf_tail.read_lines()
+                dsc_lines = dsc_tail.read_lines()
+
+                if pmf_lines or dsc_lines:
+                    last_growth = time.time()
+
+                pending.extend(pmf_lines)
+                parser.feed(dsc_lines)
+
+                idle = idle_timeout is not None and time.time() - last_growth > idle_timeout
+                if idle:
+                    # The last record has no following frame marker to finish it.
+                    parser.close()
+
+                while len(pending) >= self.FRAME_HEIGHT and frames < len(parser.records):
+                    data = pending[:self.FRAME_HEIGHT]
+                    del pending[:self.FRAME_HEIGHT]
+
+                    frame = Frame(self._parse_frame(data), parser.description(frames))
+                    frames += 1
+                    self.acq = parser.acq
+                    frame.cluster()
+                    yield frame
+
+                if idle:
+                    break
+
+                if yield_idle:
+                    yield None
+                time.sleep(poll_interval)
+        finally:
+            pmf_tail.close()
+            dsc_tail.close()
+
+    def _parse_frame(self, lines):
+        return np.array(' '.join(lines).split(), dtype=np.float64).reshape(self.FRAME_HEIGHT, -1)
 
     def frames(self):
         for frame in self._frames:
@@ -109,26 +154,57 @@ class Acquisition:
                 yield cluster
 
 
+class LineTail:
+    """
+    Reads complete lines from a file that is still being written, holding back a trailing
+    partial line until the rest of it arrives.
+    """
+    def __init__(self, filename):
+        self.file = open(filename, 'r')
+        self._partial = ''
+
+    def read_lines(self):
+        data = self.file.read()
+        if not data:
+            return []
+
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        return lines
+
+    def close(self):
+        self.file.close()
+
+
 class Frame:
-    def __init__(self, arr, description):
+    def __init__(self, arr, description, acq_time=None, acq_start=None):
         self.arr = coo_matrix(arr)
         self.description = description
-        self.acq_time = float(description['Acq time'])
-        self.acq_start = float(description['Acq Serie Start time'])
+        # Times already parsed from the typed .dsc columns are used as they are, a followed
+        # acquisition only has the values as written in the file.
+        self.acq_time = float(acq_time if acq_time is not None else description['Acq time'])
+        self.acq_start = float(acq_start if acq_start is not None else description['Acq Serie Start time'])
         self.counts = 0
-        self.clusters = []
+        self.clusters = ClusterTable([])
 
     def cluster(self):
         frame = np.squeeze(np.asarray(self.arr.todense()))
-        binary_img = binarize(frame)
-        label_image = label(binary_img, connectivity=2)
+        label_image = label(frame > 0, connectivity=2)
+
+        self.clusters = ClusterTable(regionprops(label_image, intensity_image=frame, coordinates='xy'))
+        # scikit-learn is only loaded once frames are actually being clustered.
+        from classify import classify_table
 
-        for region in regionprops(label_image, intensity_image=frame, coordinates='xy'):
-            self.clusters.append(Cluster(region))
-            self.counts += 1
+        self.clusters.track_class = classify_table(self.clusters)
+        self.counts = len(self.clusters)
         print(self.counts)
 
     def show_clusters(self):
+        # Plotting libraries are only imported here so ingest does not pay for them.
+        import matplotlib.pyplot as plt
+        from scipy.ndimage import label as nlabel
+        from scipy.ndimage import find_objects
+
         labeled, num_features = nlabel(self.arr.todense(),
                                        structure=self.connectivity_structure)
         clusters = find_objects(labeled)
@@ -140,9 +216,12 @@ class Frame:
         plt.show()
 
     def show_frame(self):
-        frame = self.arr.todense()
-        binary_img = binarize(frame)
-        label_image = label(binary_img, connectivity=2)
+        import matplotlib.pyplot as plt
+        import matplotlib.patches as mpatches
+        from skimage.color import label2rgb
+
+        frame = np.asarray(self.arr.todense())
+        label_image = label(frame > 0, connectivity=2)
         image_label_overlay = label2rgb(label_image, image=frame)
 
         fig, ax = plt.subplots(figsize=(10, 6))
@@ -201,43 +280,165 @@ class Frame:
             ax.plot(x, y, '.r', markersize=5)
 
 
-class Cluster:
-    # Calculated for our purposes
-    min_area_box = None
-    track_length = None
-    intersections = None
-    img = None
-
-    # Calculated automatically by skimage (probably still useful).
-    region_properties = None
+def track_parameters(coords):
+    """
+    Calculate the minimum area bounding box of a cluster, the intersections of its least squares
+    line with that box and the resulting track length. The intersections and track length are
+    None if the line does not cross the box twice.
+
+    :param coords:
+    :return:
+    """
+    # Calculate minimum area bounding box
+    r = cv.minAreaRect(coords)
+    box = cv.boxPoints(r)
+    box = np.flip(box)
+    min_area_box = order_points(box)
+
+    # Calculate intersections with bounding box
+    x_points = np.array([p[1] for p in coords])
+    y_points = np.array([p[0] for p in coords])
+
+    A = np.vstack([x_points, np.ones(len(x_points))]).T
+    m, c = np.linalg.lstsq(A, y_points, rcond=None)[0]
+
+    intersections = intersections_with_bbox(box, m, c)
+
+    if len(intersections) < 2:
+        print("Failed to calculate a track length because too few intersections were received.")
+        return min_area_box, None, None
+
+    return min_area_box, np.array(intersections), dist.euclidean(intersections[0], intersections[1])
+
+
+class ClusterTable:
+    """
+    Properties of all clusters in a frame stored as one array per property, with the pixel
+    coordinates and intensities of every cluster concatenated in to shared buffers. Cluster
+    images are rebuilt from the buffers when they are asked for.
+    """
+    def __init__(self, regions):
+        columns = {}
+        coords = []
+        intensities = []
+        min_area_boxes = []
+        intersections = []
+        track_lengths = []
 
-    def __init__(self, region):
-        self.calculate_cluster_parameters(region)
+        for region in regions:
+            for key in region:
+                if key == 'coords' or key in DERIVED_IMAGE_PROPERTIES:
+                    continue
+                columns.setdefault(key, []).append(region[key])
+
+            min_area_box, region_intersections, track_length = track_parameters(region.coords)
+            min_area_boxes.append(min_area_box)
+            intersections.append(region_intersections if region_intersections is not None
+                                 else np.full((2, 2), np.nan))
+            track_lengths.append(track_length if track_length is not None else np.nan)
+
+            coords.append(region.coords)
+            intensities.append(region.intensity_image[region.image])
+
+        self.columns = {key: _stack_column(values) for key, values in columns.items()}
+        self.min_area_box = np.array(min_area_boxes, dtype=np.float32).reshape(-1, 4, 2)
+        self.intersections = np.array(intersections, dtype=np.float64).reshape(-1, 2, 2)
+        self.track_length = np.array(track_lengths, dtype=np.float64)
+        self.track_class = np.full(len(track_lengths), None, dtype=object)
+
+        self.offsets = np.cumsum([0] + [len(c) for c in coords])
+        self.coords = np.concatenate(coords).astype(np.uint16) if coords else np.empty((0, 2), np.uint16)
+        self.intensities = np.concatenate(intensities) if intensities else np.empty(0)
+
+    def __len__(self):
+        return len(self.track_length)
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError("cluster index out of range")
+        return Cluster(self, index % len(self))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Cluster(self, index)
+
+    def keys(self):
+        return sorted(list(self.columns) + ['coords'] + list(DERIVED_IMAGE_PROPERTIES))
+
+    def value(self, key, index):
+        if key in self.columns:
+            return self.columns[key][index]
+        if key == 'coords':
+            return self.coords[self.offsets[index]:self.offsets[index + 1]].astype(np.intp)
+        if key == 'track_length':
+            track_length = self.track_length[index]
+            return None if np.isnan(track_length) else track_length
+        if key == 'intersections':
+            intersections = self.intersections[index]
+            return None if np.isnan(intersections).any() else intersections
+        if key == 'min_area_box':
+            return self.min_area_box[index]
+        if key == 'track_class':
+            return self.track_class[index]
+        # Fail before rebuilding the image, hasattr, copy and pickle probe unknown attributes.
+        if key not in DERIVED_IMAGE_PROPERTIES:
+            raise AttributeError("Cluster has no property {}".format(key))
+
+        bbox = self.columns['bbox'][index]
+        image = coords_to_image(self.value('coords', index), bbox)
+
+        if key == 'image':
+            return image
+        if key == 'filled_image':
+            return filled_image(image)
+        if key == 'convex_image':
+            return convex_image(image)
+        if key == 'intensity_image':
+            intensity = np.zeros(image.shape, dtype=self.intensities.dtype)
+            intensity[image] = self.intensities[self.offsets[index]:self.offsets[index + 1]]
+            return intensity
+
+
+def _stack_column(values):
+    """
+    Stack a property in to a single array when every cluster has a value of the same shape,
+    otherwise keep the list of values.
+    """
+    try:
+        column = np.array(values)
+    except ValueError:
+        return values
+
+    if column.dtype == object:
+        return values
+    return column
 
-    def calculate_cluster_parameters(self, region):
-        self.region_properties = region
 
-        # Calculate minimum area bounding box
-        r = cv.minAreaRect(region.coords)
-        box = cv.boxPoints(r)
-        box = np.flip(box)
-        self.min_area_box = order_points(box)
+class Cluster:
+    """
+    View of a single cluster in a ClusterTable. Properties are looked up by attribute or by
+    key like skimage's RegionProperties, so the cluster is its own region_properties.
+    """
+    __slots__ = ('table', 'index')
 
-        # Calculate intersections with bounding box
-        x_points = np.array([p[1] for p in region.coords])
-        y_points = np.array([p[0] for p in region.coords])
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
 
-        A = np.vstack([x_points, np.ones(len(x_points))]).T
-        m, c = np.linalg.lstsq(A, y_points, rcond=None)[0]
+    def __getattr__(self, key):
+        if key in Cluster.__slots__:
+            raise AttributeError(key)
+        return self.table.value(key, self.index)
 
-        intersections = intersections_with_bbox(box, m, c)
+    def __getitem__(self, key):
+        return self.table.value(key, self.index)
 
-        if len(intersections) < 2:
-            print("Failed to calculate a track length because too few intersections were received.")
-            return
+    def __iter__(self):
+        return iter(self.table.keys())
 
-        self.track_length = dist.euclidean(intersections[0], intersections[1])
-        self.intersections = intersections
+    @property
+    def region_properties(self):
+        return self
 
 
 def sparse_to_json(matrix):
@@ -250,6 +451,8 @@ def sanitize_for_db(conv_dict):
     d = {}
 
     for key in conv_dict:
+        if not STORE_CLUSTER_IMAGES and key in DERIVED_IMAGE_PROPERTIES:
+            continue
         if isinstance(conv_dict[key], np.ndarray):
             d[key] = json.dumps(conv_dict[key].tolist())
         elif isinstance(conv_dict[key], np.float):
@@ -261,42 +464,131 @@ def sanitize_for_db(conv_dict):
         else:
             d[key] = conv_dict[key]
 
-    d['intensity_image'] = json.dumps(conv_dict.intensity_image.tolist())
+    if STORE_CLUSTER_IMAGES:
+        d['intensity_image'] = json.dumps(conv_dict.intensity_image.tolist())
 
     return d
 
 
+def frame_to_model(frame):
+    db_frame = FrameModel()
+    db_frame.frame_data = sparse_to_json(frame.arr)
+    db_frame.acq_start = frame.acq_start
+    db_frame.acq_time = frame.acq_time
+    db_frame.description = json.dumps(frame.description)
+    db_frame.counts = len(frame.clusters)
+
+    for cluster in frame.clusters:
+        db_cluster = ClusterModel()
+        db_cluster.track_length = cluster.track_length
+        db_cluster.track_class = cluster.track_class
+        db_cluster.intersections = json.dumps(np.array(cluster.intersections).tolist())
+        db_cluster.min_area_box = json.dumps(cluster.min_area_box.tolist())
+        # db_cluster.region_properties = json.dumps(convert_dict_arrays_to_list(cluster.region_properties))
+        region_properties = sanitize_for_db(cluster.region_properties)
+
+        for prop in region_properties:
+            setattr(db_cluster, prop, region_properties[prop])
+        set_cluster_position(db_cluster, cluster.region_properties.centroid, cluster.region_properties.bbox)
+
+        db_frame.clusters.append(db_cluster)
+
+    return db_frame
+
+
 def insert_into_database(acq):
     Session = sessionmaker(bind=engine)
     session = Session()
     acquisition = AcquisitionModel(name=acq.filename)
-    # session.add(acquisition)
+    session.add(acquisition)
+    session.flush()
+    hitmaps = HitMapAccumulator()
+    events = EventRecorder(session, acquisition.id)
 
     for i, frame in enumerate(acq.load()):
-        db_frame = FrameModel()
-        db_frame.frame_data = sparse_to_json(frame.arr)
-        db_frame.acq_start = frame.acq_start
-        db_frame.acq_time = frame.acq_time
-        db_frame.description = json.dumps(frame.description)
-        db_frame.counts = len(frame.clusters)
-
-        for cluster in frame.clusters:
-            db_cluster = ClusterModel()
-            db_cluster.track_length = cluster.track_length
-            db_cluster.intersections = json.dumps(np.array(cluster.intersections).tolist())
-            db_cluster.min_area_box = json.dumps(cluster.min_area_box.tolist())
-            # db_cluster.region_properties = json.dumps(convert_dict_arrays_to_list(cluster.region_properties))
-            region_properties = sanitize_for_db(cluster.region_properties)
-
-            for prop in region_properties:
-                setattr(db_cluster, prop, region_properties[prop])
-
-            db_frame.clusters.append(db_cluster)
-
+        db_frame = frame_to_model(frame)
         acquisition.frames.append(db_frame)
+        session.flush()
+        events.add(db_frame)
+
+        hitmap = hitmaps.add(frame, db_frame.id)
+        if hitmap is not None:
+            acquisition.hitmaps.append(hitmap)
         print("Inserted frame {}".format(i))
+    events.finish()
+    session.flush()
+    index_acquisition(session, acquisition.id)
+    session.commit()
+
+
+def follow_into_database(acq, poll_interval=0.05, idle_timeout=None, commit_interval=FOLLOW_COMMIT_INTERVAL):
+    """
+    Insert the frames of an acquisition that is still being recorded. Frames are committed
+    as soon as the recording has been caught up with, or commit_interval seconds after the
+    first uncommitted frame while falling behind, so they show up in the browser straight
+    away without paying for a commit per frame at high frame rates.
+
+    :param acq:
+    :param poll_interval:
+    :param idle_timeout:
+    :param commit_interval:
+    :return:
+    """
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    acquisition = AcquisitionModel(name=acq.filename)
     session.add(acquisition)
     session.commit()
+    acquisition_id = acquisition.id
+    hitmaps = HitMapAccumulator()
+    events = EventRecorder(session, acquisition_id)
+    start = None
+    frames = 0
+    batch = []
+    batch_started = None
+
+    def commit():
+        nonlocal batch_started
+        for frame_id in batch:
+            index_frame(session, frame_id, start)
+        session.commit()
+        # Nothing is read back, so drop committed frames instead of keeping them in the session.
+        session.expunge_all()
+        del batch[:]
+        batch_started = None
+
+    # Without an idle timeout following only ends when interrupted, the frames and groups
+    # still open by then are committed on the way out.
+    try:
+        for frame in acq.follow(poll_interval, idle_timeout, yield_idle=True):
+            if frame is None:
+                if batch:
+                    commit()
+                continue
+
+            db_frame = frame_to_model(frame)
+            db_frame.acquisition_id = acquisition_id
+            session.add(db_frame)
+            session.flush()
+            if start is None:
+                start = acquisition_start(session, acquisition_id)
+
+            hitmap = hitmaps.add(frame, db_frame.id)
+            if hitmap is not None:
+                hitmap.acquisition_id = acquisition_id
+                session.add(hitmap)
+            events.add(db_frame)
+            batch.append(db_frame.id)
+            frames += 1
+            print("Inserted frame {}".format(frames - 1))
+
+            if batch_started is None:
+                batch_started = time.time()
+            if time.time() - batch_started >= commit_interval:
+                commit()
+    finally:
+        events.finish()
+        commit()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,200 @@
+import json
+
+from sqlalchemy import text, func, Integer
+
+from models import ClusterModel, FrameModel, CLUSTER_RTREE, create_spatial_index
+
+
+def set_cluster_position(db_cluster, centroid, bbox):
+    """
+    Fill the numeric centroid and bounding box columns of a cluster.
+
+    :param db_cluster:
+    :param centroid:
+    :param bbox:
+    :return:
+    """
+    db_cluster.centroid_row, db_cluster.centroid_col = [float(v) for v in centroid]
+    db_cluster.min_row, db_cluster.min_col, db_cluster.max_row, db_cluster.max_col = [int(v) for v in bbox]
+
+
+def index_acquisition(session, acquisition_id):
+    """
+    Add the clusters of an acquisition to the spatial index. Clusters ingested before the
+    numeric position columns existed are filled in from their JSON centroid and bbox first.
+
+    :param session:
+    :param acquisition_id:
+    :return:
+    """
+    missing = session.query(ClusterModel).join(FrameModel) \
+        .filter(FrameModel.acquisition_id == acquisition_id) \
+        .filter(ClusterModel.centroid_row.is_(None))
+
+    for db_cluster in missing:
+        set_cluster_position(db_cluster, json.loads(db_cluster.centroid), json.loads(db_cluster.bbox))
+    session.flush()
+
+    _insert_rtree(session, "frame.acquisition_id = :acquisition_id", {'acquisition_id': acquisition_id},
+                  acquisition_start(session, acquisition_id))
+
+
+def index_frame(session, frame_id, start=None):
+    """
+    Add the clusters of a single frame to the spatial index, used when frames are committed
+    one at a time. Callers indexing many frames of one acquisition should pass its
+    acquisition_start so it is not looked up for every frame.
+
+    :param session:
+    :param frame_id:
+    :param start:
+    :return:
+    """
+    if start is None:
+        acquisition_id = session.query(FrameModel.acquisition_id).filter(FrameModel.id == frame_id).scalar()
+        start = acquisition_start(session, acquisition_id)
+
+    _insert_rtree(session, "frame.id = :frame_id", {'frame_id': frame_id}, start)
+
+
+def unindex_acquisition(session, acquisition_id):
+    """
+    Remove the clusters of an acquisition from the spatial index.
+
+    :param session:
+    :param acquisition_id:
+    :return:
+    """
+    if not _has_rtree(session):
+        return
+
+    session.execute(text("DELETE FROM {} WHERE id IN ("
+                         "SELECT cluster.id FROM cluster JOIN frame ON cluster.frame_id = frame.id "
+                         "WHERE frame.acquisition_id = :acquisition_id)".format(CLUSTER_RTREE)),
+                    {'acquisition_id': acquisition_id})
+
+
+# Engines whose database is known to have the rtree, so the DDL only runs once per database.
+_rtree_binds = set()
+
+
+def _has_rtree(session):
+    # Checked on the session's own connection, a second connection would wait on the
+    # session's uncommitted writes on SQLite.
+    connection = session.connection()
+    return connection.dialect.name == 'sqlite' and connection.dialect.has_table(connection, CLUSTER_RTREE)
+
+
+def _insert_rtree(session, where, params, start):
+    bind = session.get_bind()
+    if bind not in _rtree_binds:
+        if not create_spatial_index(session.connection()):
+            return
+        _rtree_binds.add(bind)
+
+    # The rtree stores 32 bit floats and rounds outwards, so it is only used as a prefilter.
+    # Absolute Unix times are only resolved to about two minutes at that precision, so frame
+    # start times are stored relative to the start of their acquisition.
+    session.execute(text("INSERT OR REPLACE INTO {} "
+                         "SELECT cluster.id, cluster.min_row, cluster.max_row, "
+                         "cluster.min_col, cluster.max_col, "
+                         "frame.acq_start - :start, frame.acq_start - :start "
+                         "FROM cluster JOIN frame ON cluster.frame_id = frame.id "
+                         "WHERE {}".format(CLUSTER_RTREE, where)), dict(params, start=start))
+
+
+def acquisition_start(session, acquisition_id):
+    """
+    Start time of the first frame of an acquisition, the origin of the times in the rtree.
+
+    :param session:
+    :param acquisition_id:
+    :return:
+    """
+    return session.query(func.min(FrameModel.acq_start)) \
+        .filter(FrameModel.acquisition_id == acquisition_id) \
+        .scalar()
+
+
+def query_clusters(session, acquisition_id=None, region=None, t0=None, t1=None, overlapping=False,
+                   track_class=None):
+    """
+    Query clusters whose centroid lies in region and whose frame started between t0 and t1.
+    With overlapping=True any cluster whose bounding box intersects region is returned instead.
+    Results can be limited to one of classify.TRACK_CLASSES with track_class.
+
+    Region is given as (min_row, min_col, max_row, max_col) with the max values exclusive,
+    the same convention as a cluster's bbox. On SQLite the clusters must have been added to
+    the rtree with index_acquisition, which ingest does.
+
+    :param session:
+    :param acquisition_id:
+    :param region:
+    :param t0:
+    :param t1:
+    :param overlapping:
+    :param track_class:
+    :return: A ClusterModel query ordered by frame start time.
+    """
+    query = session.query(ClusterModel).join(FrameModel)
+
+    if acquisition_id is not None:
+        query = query.filter(FrameModel.acquisition_id == acquisition_id)
+    if t0 is not None:
+        query = query.filter(FrameModel.acq_start >= t0)
+    if t1 is not None:
+        query = query.filter(FrameModel.acq_start <= t1)
+    if track_class is not None:
+        query = query.filter(ClusterModel.track_class == track_class)
+
+    if region is not None:
+        min_row, min_col, max_row, max_col = region
+
+        if overlapping:
+            query = query.filter(ClusterModel.max_row > min_row, ClusterModel.min_row < max_row,
+                                 ClusterModel.max_col > min_col, ClusterModel.min_col < max_col)
+        else:
+            query = query.filter(ClusterModel.centroid_row >= min_row, ClusterModel.centroid_row < max_row,
+                                 ClusterModel.centroid_col >= min_col, ClusterModel.centroid_col < max_col)
+
+    # Rtree times are relative to the start of each acquisition, so the time window can only
+    # narrow the prefilter within a single acquisition.
+    start = None
+    if acquisition_id is not None and (t0 is not None or t1 is not None):
+        start = acquisition_start(session, acquisition_id)
+    if start is None:
+        t0 = t1 = None
+    else:
+        t0 = t0 - start if t0 is not None else None
+        t1 = t1 - start if t1 is not None else None
+
+    if (region is not None or t0 is not None or t1 is not None) and _has_rtree(session):
+        query = query.filter(ClusterModel.id.in_(_rtree_candidates(region, t0, t1)))
+
+    return query.order_by(FrameModel.acq_start, ClusterModel.id)
+
+
+def _rtree_candidates(region, t0, t1):
+    """
+    Subquery selecting the ids of clusters whose rtree entry can match the query. A centroid
+    inside region implies the bounding box intersects it, so both query modes can use it.
+    t0 and t1 are relative to the start of the acquisition.
+    """
+    conditions = []
+    params = {}
+
+    if region is not None:
+        min_row, min_col, max_row, max_col = region
+        conditions.extend(["max_row > :min_row", "min_row < :max_row",
+                           "max_col > :min_col", "min_col < :max_col"])
+        params.update(min_row=min_row, min_col=min_col, max_row=max_row, max_col=max_col)
+    if t0 is not None:
+        conditions.append("max_time >= :t0")
+        params['t0'] = t0
+    if t1 is not None:
+        conditions.append("min_time <= :t1")
+        params['t1'] = t1
+
+    where = " AND ".join(conditions) if conditions else "1"
+    return text("SELECT id FROM {} WHERE {}".format(CLUSTER_RTREE, where)) \
+        .bindparams(**params).columns(id=Integer)
@@ -11,11 +11,26 @@ def generate_frame_plot(frame):
     sparse_data = json.loads(frame.frame_data)
 
     img = np.array(sparse_to_dense(sparse_data))
+    labels = []
+
+    for i, cluster in enumerate(frame.clusters):
+        bbox = json.loads(cluster.bbox)
+        labels.append(Label(x=bbox[3], y=bbox[2], text=str(i + 1), text_color='red', text_font_size="8pt"))
+
+    return generate_image_plot(img, "Frame {}".format(frame.id), labels)
+
+
+def generate_hitmap_plot(img, start, stop, kind):
+    return generate_image_plot(np.array(img, dtype=np.float64),
+                               "Integrated {} of frames {} to {}".format(kind, start, stop - 1))
+
+
+def generate_image_plot(img, title, labels=()):
     source = ColumnDataSource(data={'data': img.flatten()})
     plot = figure(x_range=(0, 256), y_range=(0, 256), width=750, height=750,
                   tools='hover,box_zoom,crosshair,reset,save',
                   tooltips=[("x", "$x"), ("y", "$y"), ("value", "@image")],
-                  title="Frame {}".format(frame.id))
+                  title=title)
     im = plot.image(image=[img], x=0, y=0, dw=256, dh=256, palette="Viridis11")
 
     range_slider_callback = CustomJS(args=dict(source=source, im=im), code="""
@@ -39,9 +54,7 @@ def generate_frame_plot(frame):
                 image_source.change.emit();
             """)
 
-    for i, cluster in enumerate(frame.clusters):
-        bbox = json.loads(cluster.bbox)
-        label = Label(x=bbox[3], y=bbox[2], text=str(i + 1), text_color='red', text_font_size="8pt")
+    for label in labels:
         plot.add_layout(label)
     slider = RangeSlider(start=1, end=np.max(img) + 2, step=1, title="View Window", value=(1, np.max(img)))
     slider.js_on_change('value', range_slider_callback)